@@ -83,9 +83,11 @@ def build_parser():
                         type=int,
                         default=1,
                         help=("The number of threads to use. Set to -1 to use "
-                              "the number of cpus on this machine. If a file "
-                              "format doesn't support threaded packaging, this "
-                              "option will be ignored. Default is 1."))
+                              "the number of cpus on this machine. Files are "
+                              "read and their prefixes rewritten in parallel "
+                              "for all formats; if a file format doesn't "
+                              "support threaded compression, that step remains "
+                              "serial. Default is 1."))
     parser.add_argument("--zip-symlinks",
                         action="store_true",
                         help=("Symbolic links aren't supported by the Zip "
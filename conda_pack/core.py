@@ -1,5 +1,6 @@
 import glob
 import json
+import mmap
 import os
 import re
 import shlex
@@ -7,10 +8,13 @@ import shutil
 import subprocess
 import sys
 import tempfile
+import threading
 import warnings
-from contextlib import contextmanager
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 from datetime import datetime
-from fnmatch import fnmatch
+from fnmatch import translate
 from pathlib import Path
 
 import pkg_resources
@@ -33,6 +37,8 @@ PREFIX_PLACEHOLDER = ('/opt/anaconda1anaconda2'
 
 BIN_DIR = 'Scripts' if on_win else 'bin'
 
+_match_shebang = re.compile(SHEBANG_REGEX, re.MULTILINE).match
+
 _current_dir = os.path.dirname(__file__)
 if on_win:
     _scripts = [(os.path.join(_current_dir, 'scripts', 'windows', 'activate.bat'),
@@ -71,6 +77,20 @@ class _Context:
 context = _Context()
 
 
+def _compile_pattern(pattern):
+    """Compile a glob ``pattern`` into a predicate on ``File`` targets.
+
+    Equivalent to ``fnmatch(f.target, pattern)``, but the pattern is only
+    translated and compiled once."""
+    match = re.compile(translate(os.path.normcase(pattern))).match
+    if on_win:
+        return lambda f: match(os.path.normcase(f.target)) is not None
+    return lambda f: match(f.target) is not None
+
+
+_is_conda_meta_json = _compile_pattern('conda-meta/*.json')
+
+
 class CondaEnv:
     """A Conda environment for packaging.
 
@@ -194,8 +214,9 @@ class CondaEnv:
         excluded = list(self._excluded_files)  # copy
         include = files.append
         exclude = excluded.append
+        matches = _compile_pattern(pattern)
         for f in self.files:
-            if fnmatch(f.target, pattern):
+            if matches(f):
                 exclude(f)
             else:
                 include(f)
@@ -219,8 +240,9 @@ class CondaEnv:
         excluded = []
         include = files.append
         exclude = excluded.append
+        matches = _compile_pattern(pattern)
         for f in self._excluded_files:
-            if fnmatch(f.target, pattern):
+            if matches(f):
                 include(f)
             else:
                 exclude(f)
@@ -337,6 +359,9 @@ class CondaEnv:
             'no-archive'}
             The archival format to use. By default this is inferred from the
             output file extension, and defaults to ``tar.gz`` if this is not supplied.
+            Tar-based formats are written in a single streaming pass, while ``zip``
+            keeps a central directory record for every file in memory until the
+            archive is closed; prefer a tar-based format for very large environments.
         arcroot : str, optional
             The relative path in the archive to the conda environment.
             Defaults to ''.
@@ -371,8 +396,9 @@ class CondaEnv:
             compression time. Ignored for ``format='zip'``. Default is 4.
         n_threads : int, optional
             The number of threads to use. Set to -1 to use the number of cpus
-            on this machine. If a file format doesn't support threaded
-            packaging, this option will be ignored. Default is 1.
+            on this machine. Files are read and their prefixes rewritten in
+            parallel for all formats; if a file format doesn't support threaded
+            compression, that step remains serial. Default is 1.
         zip_symlinks : bool, optional
             (``zip`` format only) Symbolic links aren't supported by the Zip standard,
             but are supported by *many* common Zip implementations. If ``True``, symbolic
@@ -389,10 +415,11 @@ class CondaEnv:
         out_path : str
             The path to the archived environment.
         """
-        from .formats import archive
+        from .formats import _parse_n_threads, archive
 
         # The output path and archive format
         output, format = self._output_and_format(output, format)
+        n_threads = _parse_n_threads(n_threads)
 
         if format == "parcel":
             if dest_prefix or arcroot:
@@ -414,7 +441,18 @@ class CondaEnv:
         if verbose:
             print(f"Packing environment at {self.prefix!r} to {output!r}")
 
-        fd, temp_path = tempfile.mkstemp()
+        if format == "no-archive":
+            # Files are written directly into the output directory
+            fd = temp_path = None
+        else:
+            # Write to a temporary file next to the output, so that moving it
+            # into place is a rename on the same filesystem rather than a full
+            # copy.
+            fd, temp_path = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(output)),
+                prefix=".condapack-",
+                suffix=".tmp",
+            )
 
         try:
             history_file = Path(self.prefix) / "conda-meta" / "history"
@@ -422,7 +460,7 @@ class CondaEnv:
                 mtime = history_file.lstat().st_mtime
             else:
                 mtime = None
-            with os.fdopen(fd, "wb") as temp_file:
+            with (nullcontext() if fd is None else os.fdopen(fd, "wb")) as temp_file:
                 with archive(
                     temp_file,
                     temp_path,
@@ -438,19 +476,26 @@ class CondaEnv:
                 ) as arc:
                     packer = Packer(self.prefix, arc, dest_prefix, parcel)
 
+                    if n_threads == 1:
+                        prepared = map(packer.prepare, self.files)
+                    else:
+                        prepared = _map_threaded(packer.prepare, self.files, n_threads)
+
                     with progressbar(self.files, enabled=verbose) as files:
-                        for f in files:
-                            packer.add(f)
+                        for f, p in zip(files, prepared):
+                            packer.commit(f, p)
 
                     packer.finish()
 
-        except Exception:
-            # Writing failed, remove tempfile
-            os.remove(temp_path)
+        except BaseException:
+            # Writing failed or was interrupted, remove tempfile
+            if temp_path is not None:
+                os.remove(temp_path)
             raise
         else:
             # Writing succeeded, move archive to desired location
-            shutil.move(temp_path, output)
+            if temp_path is not None:
+                shutil.move(temp_path, output)
 
         return output
 
@@ -471,7 +516,7 @@ class File:
     prefix_placeholder : None or str, optional
         The prefix placeholder in the file (if any)
     """
-    __slots__ = ('source', 'target', 'is_conda', 'file_mode',
+    __slots__ = ('_root', '_path', 'target', 'is_conda', 'file_mode',
                  'prefix_placeholder')
 
     def __init__(self, source, target, is_conda=True, file_mode=None,
@@ -482,6 +527,29 @@ class File:
         self.file_mode = file_mode
         self.prefix_placeholder = prefix_placeholder
 
+    @classmethod
+    def _relative_to(cls, root, path, target=None, **kwargs):
+        """Create a ``File`` with source ``os.path.join(root, path)``.
+
+        The source is joined on access rather than stored. Environments have
+        many files sharing a few roots, and ``path`` is usually the target, so
+        this avoids keeping a copy of every full path in memory."""
+        self = cls(None, path if target is None else target, **kwargs)
+        self._root = root
+        self._path = path
+        return self
+
+    @property
+    def source(self):
+        if self._root is None:
+            return self._path
+        return os.path.join(self._root, self._path)
+
+    @source.setter
+    def source(self, source):
+        self._root = None
+        self._path = source
+
     def __repr__(self):
         return f"File<{self.target!r}, is_conda={self.is_conda!r}>"
 
@@ -523,6 +591,9 @@ def pack(
         'no-archive'}, optional
         The archival format to use. By default, this is inferred from the output
         file extension, and defaults to ``tar.gz`` if ``output`` is not supplied.
+        Tar-based formats are written in a single streaming pass, while ``zip``
+        keeps a central directory record for every file in memory until the
+        archive is closed; prefer a tar-based format for very large environments.
     arcroot : str, optional
         The relative path in the archive to the conda environment.
         Defaults to ''.
@@ -564,8 +635,9 @@ def pack(
         the default is ``False``.
     n_threads : int, optional
         The number of threads to use. Set to -1 to use the number of cpus on
-        this machine. If a file format doesn't support threaded packaging, this
-        option will be ignored. Default is 1.
+        this machine. Files are read and their prefixes rewritten in parallel
+        for all formats; if a file format doesn't support threaded compression,
+        that step remains serial. Default is 1.
     zip_64 : bool, optional
         (``zip`` format only) Whether to enable ZIP64 extensions. Default is True.
     filters : list, optional
@@ -632,14 +704,17 @@ def pack(
     )
 
 
-def find_site_packages(prefix):
+def find_site_packages(prefix, metas=None):
+    if metas is None:
+        metas = []
+        with os.scandir(os.path.join(prefix, 'conda-meta')) as entries:
+            for entry in entries:
+                if entry.name.startswith('python-') and entry.name.endswith('.json'):
+                    with open(entry.path, 'rb') as fil:
+                        metas.append(json.load(fil))
+
     # Ensure there is at most one version of python installed
-    pythons = []
-    for fn in glob.glob(os.path.join(prefix, 'conda-meta', 'python-*.json')):
-        with open(fn) as fil:
-            meta = json.load(fil)
-        if meta['name'] == 'python':
-            pythons.append(meta)
+    pythons = [meta for meta in metas if meta['name'] == 'python']
 
     if len(pythons) > 1:  # pragma: nocover
         raise CondaPackException("Unexpected failure, multiple versions of "
@@ -687,16 +762,19 @@ def check_no_editable_packages(prefix, site_packages):
 def name_to_prefix(name=None):
     try:
         conda_exe = os.environ.get("CONDA_EXE", "conda")
+        # Run conda directly rather than through a shell, except on Windows
+        # where it may be a batch script
         info = subprocess.check_output(
-            f"{conda_exe} info --json", shell=True, stderr=subprocess.PIPE
+            [conda_exe, "info", "--json"], shell=on_win, stderr=subprocess.PIPE
         ).decode(default_encoding)
-    except subprocess.CalledProcessError as exc:
+    except (subprocess.CalledProcessError, OSError) as exc:
         kind = ('current environment' if name is None
                 else 'environment: %r' % name)
+        error = getattr(exc, 'output', None) or exc
         raise CondaPackException("Failed to determine path to %s. This may "
                                  "be due to conda not being on your PATH. The "
                                  "full error is below:\n\n"
-                                 "%s" % (kind, exc.output))
+                                 "%s" % (kind, error))
     info2 = json.loads(info)
 
     if name:
@@ -711,12 +789,22 @@ def name_to_prefix(name=None):
     return prefix
 
 
+def _load_json_if_exists(path):
+    """Load a json file, returning None if it doesn't exist.
+
+    Opening directly avoids a separate existence check per file."""
+    try:
+        fil = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+    with fil:
+        return json.load(fil)
+
+
 def read_noarch_type(pkg):
     for file_name in ['link.json', 'package_metadata.json']:
-        path = os.path.join(pkg, 'info', file_name)
-        if os.path.exists(path):
-            with open(path) as fil:
-                info = json.load(fil)
+        info = _load_json_if_exists(os.path.join(pkg, 'info', file_name))
+        if info is not None:
             try:
                 return info['noarch']['type']
             except KeyError:
@@ -724,11 +812,25 @@ def read_noarch_type(pkg):
     return None
 
 
+# Runs of anything but shlex's whitespace characters. Unlike str.split, this
+# leaves other (e.g. unicode) whitespace inside paths untouched.
+_find_shlex_words = re.compile(r"[^ \t\r\n]+").findall
+
+
+def _split_has_prefix_line(line):
+    if '"' in line or "'" in line:
+        # Quoted fields may contain whitespace, leave those to shlex
+        return tuple(x.strip('"\'') for x in shlex.split(line, posix=False))
+    # Otherwise this is equivalent to shlex.split(line, posix=False), and
+    # much faster
+    return tuple(_find_shlex_words(line))
+
+
 def read_has_prefix(path):
     out = {}
     with open(path) as fil:
         for line in fil:
-            rec = tuple(x.strip('"\'') for x in shlex.split(line, posix=False))
+            rec = _split_has_prefix_line(line)
             if len(rec) == 1:
                 out[rec[0]] = (PREFIX_PLACEHOLDER, 'text')
             elif len(rec) == 3:
@@ -738,66 +840,86 @@ def read_has_prefix(path):
     return out
 
 
+# Top-level names in the prefix that are never packed
+_IGNORED_NAMES = frozenset({
+    "pkgs",
+    "envs",
+    "conda-bld",
+    ".conda_lock",
+    "users",
+    "conda-recipes",
+    ".index",
+    ".unionfs",
+    ".nonadmin",
+    "python.app",
+    "Launcher.app",
+})
+_IGNORED_SUFFIXES = ('~', '.DS_STORE')
+
+
 def load_files(prefix):
-    from os.path import isfile, islink, join, relpath
-
-    ignore = {
-        "pkgs",
-        "envs",
-        "conda-bld",
-        ".conda_lock",
-        "users",
-        "conda-recipes",
-        ".index",
-        ".unionfs",
-        ".nonadmin",
-        "python.app",
-        "Launcher.app",
-    }
+    from os.path import join
 
     res = set()
-
-    for fn in os.listdir(prefix):
-        if fn in ignore or fn.endswith('~') or fn.endswith('.DS_STORE'):
+    # Stack of (absolute path, path relative to prefix) of directories to
+    # visit. Using scandir lets us classify entries without a stat per file.
+    stack = []
+
+    with os.scandir(prefix) as entries:
+        for entry in entries:
+            fn = entry.name
+            if fn in _IGNORED_NAMES or fn.endswith(_IGNORED_SUFFIXES):
+                continue
+            elif entry.is_file() or entry.is_symlink():
+                res.add(fn)
+            elif entry.is_dir():
+                stack.append((entry.path, fn))
+
+    while stack:
+        root, root2 = stack.pop()
+        try:
+            with os.scandir(root) as entries:
+                entries = list(entries)
+        except OSError:
+            # Unreadable directories are skipped, as with os.walk
             continue
-        elif isfile(join(prefix, fn)):
-            res.add(fn)
-        elif islink(join(prefix, fn)):
-            res.add(fn)
-        else:
-            for root, dirs, files in os.walk(join(prefix, fn)):
-                root2 = relpath(root, prefix)
-                res.update(join(root2, fn2) for fn2 in files)
 
-                for d in dirs:
-                    if islink(join(root, d)):
-                        # Add symbolic directory directly
-                        res.add(join(root2, d))
+        if not entries:
+            # root2 is an empty directory, add it
+            res.add(root2)
 
-                if not dirs and not files:
-                    # root2 is an empty directory, add it
-                    res.add(root2)
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append((entry.path, join(root2, entry.name)))
+            else:
+                # Files and symbolic links (including links to directories)
+                # are added directly
+                res.add(join(root2, entry.name))
 
     return res
 
 
+_NOARCH_PREFIXES = ('site-packages/', 'python-scripts/')
+
+
 def managed_file(is_noarch, site_packages, pkg, _path, prefix_placeholder=None,
                  file_mode=None, **ignored):
-    if is_noarch:
-        if _path.startswith('site-packages/'):
+    # Most paths match neither prefix, so check both at once before
+    # working out which one matched.
+    if is_noarch and _path.startswith(_NOARCH_PREFIXES):
+        if _path[0] == 's':  # site-packages/
             target = site_packages + _path[13:]
-        elif _path.startswith('python-scripts/'):
+        else:  # python-scripts/
             target = BIN_DIR + _path[14:]
-        else:
-            target = _path
     else:
         target = _path
 
-    return File(os.path.join(pkg, _path),
-                target,
-                is_conda=True,
-                prefix_placeholder=prefix_placeholder,
-                file_mode=file_mode)
+    return File._relative_to(pkg,
+                             _path,
+                             target,
+                             is_conda=True,
+                             prefix_placeholder=prefix_placeholder,
+                             file_mode=file_mode)
 
 
 def load_managed_package(info, prefix, site_packages, all_files):
@@ -812,26 +934,22 @@ def load_managed_package(info, prefix, site_packages, all_files):
                                  "Python not found in environment (%r)" %
                                  (info['name'], prefix))
 
-    paths_json = os.path.join(pkg, 'info', 'paths.json')
-    if os.path.exists(paths_json):
-        with open(paths_json) as fil:
-            paths = json.load(fil)
-
+    paths = _load_json_if_exists(os.path.join(pkg, 'info', 'paths.json'))
+    if paths is not None:
         files = [managed_file(is_noarch, site_packages, pkg, **r)
                  for r in paths['paths']]
     else:
         with open(os.path.join(pkg, 'info', 'files')) as fil:
             paths = [f.strip() for f in fil]
 
-        has_prefix = os.path.join(pkg, 'info', 'has_prefix')
-
-        if os.path.exists(has_prefix):
-            prefixes = read_has_prefix(has_prefix)
-            files = [managed_file(is_noarch, site_packages, pkg, p,
-                                  *prefixes.get(p, ())) for p in paths]
-        else:
+        try:
+            prefixes = read_has_prefix(os.path.join(pkg, 'info', 'has_prefix'))
+        except FileNotFoundError:
             files = [managed_file(is_noarch, site_packages, pkg, p)
                      for p in paths]
+        else:
+            files = [managed_file(is_noarch, site_packages, pkg, p,
+                                  *prefixes.get(p, ())) for p in paths]
 
     if is_noarch:
         seen = {os.path.normcase(i.target) for i in files}
@@ -844,8 +962,8 @@ def load_managed_package(info, prefix, site_packages, all_files):
                     ((fil_normed == ".nonadmin") or
                      (fil_normed.endswith('.pyc') and fil_normed not in all_files))):
                 file_mode = 'unknown' if fil.startswith(BIN_DIR) else None
-                f = File(os.path.join(prefix, fil), fil, is_conda=True,
-                         prefix_placeholder=None, file_mode=file_mode)
+                f = File._relative_to(prefix, fil, is_conda=True,
+                                      prefix_placeholder=None, file_mode=file_mode)
                 files.append(f)
     return files
 
@@ -879,6 +997,15 @@ conda/pip conflicts using `conda list`, and fix the environment by ensuring
 only one version of each package is installed (conda preferred)."""
 
 
+# Older versions of conda insert unmanaged conda, activate, and deactivate
+# scripts into child environments upon activation. These are removed.
+_stale_script_names = ('conda', 'activate', 'deactivate')
+if on_win:
+    # Windows includes the POSIX and .bat versions of each
+    _stale_script_names += ('conda.bat', 'activate.bat', 'deactivate.bat')
+_STALE_SCRIPTS = frozenset(os.path.join(BIN_DIR, f) for f in _stale_script_names)
+
+
 def load_environment(prefix, on_missing_cache='warn', ignore_editable_packages=False,
                      ignore_missing_files=False):
     # Check if it's a conda environment
@@ -888,8 +1015,19 @@ def load_environment(prefix, on_missing_cache='warn', ignore_editable_packages=F
     if not os.path.exists(conda_meta):
         raise CondaPackException("Path %r is not a conda environment" % prefix)
 
+    # List the conda-meta records once. Only the python records are read up
+    # front, the rest are read one at a time below so that only a single
+    # package's file list is held in memory.
+    meta_paths = [p for p in os.listdir(conda_meta) if p.endswith('.json')]
+    python_metas = {}
+    for path in meta_paths:
+        if path.startswith('python-'):
+            # json accepts bytes directly, skipping the text decoding layer
+            with open(os.path.join(conda_meta, path), 'rb') as fil:
+                python_metas[path] = json.load(fil)
+
     # Find the environment site_packages (if any)
-    site_packages = find_site_packages(prefix)
+    site_packages = find_site_packages(prefix, list(python_metas.values()))
 
     if site_packages is not None and not ignore_editable_packages:
         # Check that no editable packages are installed
@@ -904,49 +1042,49 @@ def load_environment(prefix, on_missing_cache='warn', ignore_editable_packages=F
     managed = set()
     uncached = []
     missing_files = {}
-    for path in os.listdir(conda_meta):
-        if path.endswith('.json'):
-            with open(os.path.join(conda_meta, path)) as fil:
+    for path in meta_paths:
+        info = python_metas.pop(path, None)
+        if info is None:
+            with open(os.path.join(conda_meta, path), 'rb') as fil:
                 info = json.load(fil)
-
-            pkg = info['link']['source'] if info['link'] else ""
-
-            if not os.path.exists(pkg):
-                # Package cache is cleared, set file_mode='unknown' to properly
-                # handle prefix replacement ourselves later.
-                new_files = [File(os.path.join(prefix, f), f, is_conda=True,
-                                  prefix_placeholder=None, file_mode='unknown')
-                             for f in info['files'] if f != '.nonadmin']
-                uncached.append((info['name'], info['version'], info['url']))
-            else:
-                new_files = load_managed_package(info, prefix, site_packages,
-                                                 all_files)
-
-            targets = {os.path.normcase(f.target) for f in new_files}
-            new_missing = targets.difference(all_files)
-
-            if new_missing:
-                # Collect packages missing files as we progress to provide a
-                # complete error message on failure.
-                missing_files[(info["name"], info["version"])] = new_missing
-
-                if ignore_missing_files:
-                    # Filter out missing files
-                    new_files = [
-                        f
-                        for f in new_files
-                        if os.path.normcase(f.target) not in new_missing
-                    ]
-
-            managed.update(targets)
-            files.extend(new_files)
-            # Add conda-meta entry
-            managed.add(os.path.join('conda-meta', path))
-            files.append(File(os.path.join(conda_meta, path),
-                              os.path.join('conda-meta', path),
-                              is_conda=True,
-                              prefix_placeholder=None,
-                              file_mode=None))
+        pkg = info['link']['source'] if info['link'] else ""
+
+        if not os.path.exists(pkg):
+            # Package cache is cleared, set file_mode='unknown' to properly
+            # handle prefix replacement ourselves later.
+            new_files = [File._relative_to(prefix, f, is_conda=True,
+                                           prefix_placeholder=None, file_mode='unknown')
+                         for f in info['files'] if f != '.nonadmin']
+            uncached.append((info['name'], info['version'], info['url']))
+        else:
+            new_files = load_managed_package(info, prefix, site_packages,
+                                             all_files)
+
+        targets = {os.path.normcase(f.target) for f in new_files}
+        new_missing = targets.difference(all_files)
+
+        if new_missing:
+            # Collect packages missing files as we progress to provide a
+            # complete error message on failure.
+            missing_files[(info["name"], info["version"])] = new_missing
+
+            if ignore_missing_files:
+                # Filter out missing files
+                new_files = [
+                    f
+                    for f in new_files
+                    if os.path.normcase(f.target) not in new_missing
+                ]
+
+        managed.update(targets)
+        files.extend(new_files)
+        # Add conda-meta entry
+        managed.add(os.path.join('conda-meta', path))
+        files.append(File(os.path.join(conda_meta, path),
+                          os.path.join('conda-meta', path),
+                          is_conda=True,
+                          prefix_placeholder=None,
+                          file_mode=None))
 
     # Add remaining conda metadata files
     if os.path.exists(os.path.join(conda_meta, "history")):
@@ -972,22 +1110,20 @@ def load_environment(prefix, on_missing_cache='warn', ignore_editable_packages=F
         packages = "\n".join(packages)
         raise CondaPackException(_missing_files_error.format(packages))
 
-    # Add unmanaged files, preserving their original case
-    unmanaged = {fn for fn_l, fn in all_files.items() if fn_l not in managed}
-    # Older versions of conda insert unmanaged conda, activate, and deactivate
-    # scripts into child environments upon activation. Remove these
-    fnames = ('conda', 'activate', 'deactivate')
-    if on_win:
-        # Windows includes the POSIX and .bat versions of each
-        fnames = fnames + ('conda.bat', 'activate.bat', 'deactivate.bat')
-    unmanaged -= {os.path.join(BIN_DIR, f) for f in fnames}
-
-    files.extend(File(os.path.join(prefix, p),
-                      p,
-                      is_conda=False,
-                      prefix_placeholder=None,
-                      file_mode='unknown')
-                 for p in unmanaged if not find_py_source(p) in managed)
+    # Add unmanaged files, preserving their original case. Done in a single
+    # pass over all files, with the membership tests bound once up front.
+    # Only paths under a ``__pycache__`` directory can map back to a python
+    # source, so the bytecode lookup is skipped for everything else.
+    is_managed = managed.__contains__
+    is_skipped = _STALE_SCRIPTS.__contains__
+    files.extend(File._relative_to(prefix,
+                                   p,
+                                   is_conda=False,
+                                   prefix_placeholder=None,
+                                   file_mode='unknown')
+                 for p_l, p in all_files.items()
+                 if not (is_managed(p_l) or is_skipped(p) or
+                         ('__pycache__' in p and is_managed(find_py_source(p)))))
 
     if uncached and on_missing_cache in ('warn', 'raise'):
         packages = '\n'.join('- %s=%r   %s' % i for i in uncached)
@@ -999,6 +1135,26 @@ def load_environment(prefix, on_missing_cache='warn', ignore_editable_packages=F
     return files
 
 
+def _map_threaded(func, items, n_threads, chunksize=64):
+    """Like ``map``, but runs ``func`` in a pool of ``n_threads`` threads.
+
+    Items are processed in chunks of ``chunksize``, and results are yielded in
+    order. At most ``n_threads + 1`` chunks are run ahead of the consumer, so
+    the number of results held at once is bounded by item count, not by size:
+    up to ``(n_threads + 1) * chunksize`` results may be held in memory."""
+    def run(chunk):
+        return [func(i) for i in chunk]
+
+    pending = deque()
+    with ThreadPoolExecutor(n_threads) as executor:
+        for start in range(0, len(items), chunksize):
+            if len(pending) > n_threads:
+                yield from pending.popleft().result()
+            pending.append(executor.submit(run, items[start:start + chunksize]))
+        while pending:
+            yield from pending.popleft().result()
+
+
 def rewrite_shebang(data, target, prefix):
     """Rewrite a shebang header to ``#!usr/bin/env program...``.
 
@@ -1008,23 +1164,23 @@ def rewrite_shebang(data, target, prefix):
     fixed : bool
         Whether the file was successfully fixed in the rewrite.
     """
-    shebang_match = re.match(SHEBANG_REGEX, data, re.MULTILINE)
+    shebang_match = _match_shebang(data)
     prefix_b = prefix.encode('utf-8')
 
     if shebang_match:
-        if data.count(prefix_b) > 1:
-            # More than one occurrence of prefix, can't fully cleanup.
-            return data, False
-
         shebang, executable, options = shebang_match.groups()
 
         if executable.startswith(prefix_b):
+            if data.find(prefix_b, shebang_match.start(2) + len(prefix_b)) != -1:
+                # More than one occurrence of prefix, can't fully cleanup.
+                return data, False
+
             # shebang points inside environment, rewrite
             executable_name = executable.decode("utf-8").split("/")[-1]
             new_shebang = "#!/usr/bin/env {}{}".format(
                 executable_name, options.decode("utf-8")
             )
-            data = data.replace(shebang, new_shebang.encode("utf-8"))
+            data = new_shebang.encode("utf-8") + data[shebang_match.end():]
 
             return data, True
 
@@ -1130,6 +1286,15 @@ def is_binary_file(data):
         return True
 
 
+# Files at least this large are memory-mapped when searching for the prefix,
+# rather than being read into memory up front.
+_MMAP_THRESHOLD = 2**20
+
+
+def _contains_any(data, needles, end):
+    return any(data.find(n, 0, end) != -1 for n in needles)
+
+
 class Packer:
     def __init__(self, prefix, archive, dest_prefix=None, parcel=None):
         self.prefix = prefix
@@ -1139,58 +1304,89 @@ class Packer:
         self.parcel = parcel
         self.prefixes = []
         self.packages = []
+        self._local = threading.local()
+
+    def _read_buffer(self):
+        """A reusable buffer for reading small files, one per thread."""
+        buf = getattr(self._local, 'buffer', None)
+        if buf is None:
+            buf = self._local.buffer = bytearray(_MMAP_THRESHOLD)
+        return buf
+
+    def _read_if_has_prefix(self, path, prefix):
+        """Read the file at ``path`` if it contains ``prefix``.
+
+        Returns the file contents, or None if the prefix isn't present. Small
+        files are read into a reusable buffer and searched in place, larger
+        files are memory-mapped. Either way, the contents are only copied out
+        if the prefix is found."""
+        prefix_b = prefix.encode('utf-8')
+        # Windows binary replacement also matches the lowercased prefix
+        needles = (prefix_b, prefix_b.lower()) if on_win else (prefix_b,)
+        with open(path, 'rb', buffering=0) as fil:
+            if os.fstat(fil.fileno()).st_size < _MMAP_THRESHOLD:
+                buf = self._read_buffer()
+                view = memoryview(buf)
+                n = 0
+                while n < len(buf):
+                    nread = fil.readinto(view[n:])
+                    if not nread:
+                        break
+                    n += nread
+                else:
+                    # The file grew past the buffer while reading it
+                    data = bytes(view) + fil.read()
+                    return data if _contains_any(data, needles, len(data)) else None
+                return bytes(view[:n]) if _contains_any(buf, needles, n) else None
+            with mmap.mmap(fil.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return mm[:] if _contains_any(mm, needles, len(mm)) else None
 
     def add(self, file):
-        # Windows note:
-        # When adding files to an archive, that archive is generally
-        # case-sensitive.  The target paths can be mixed case, and that means
-        # that they will be distinct directories in the archive.
-        #
-        # If those files are then extracted onto a case-sensitive file-system
-        # (such as a network share), Windows will not be able to traverse them
-        # correctly.
-        #
-        # The simple (undesirable) solution is to normalize (lowercase) the
-        # filenames when adding them to the archive.
-        #
-        # A nicer solution would be to note the "canonical" capitalization of a
-        # prefix when it first occurs, and use that every time the prefix
-        # occurs subsequently.
-        #
-        # We just ignore this problem for the time being.
+        """Add a single file to the archive."""
+        self.commit(file, self.prepare(file))
+
+    def prepare(self, file):
+        """Read and rewrite ``file`` as needed, without touching the archive.
+
+        This may be called from multiple threads at once. Returns a tuple of
+        ``(data, prefix_record, package)`` to be passed to :meth:`commit`,
+        where ``data`` is None if the file can be archived from disk as is.
+        """
+        source = file.source
         if file.file_mode is None:
-            if fnmatch(file.target, 'conda-meta/*.json'):
+            if _is_conda_meta_json(file):
                 # Detect if conda is installed
-                out, data = rewrite_conda_meta(file.source)
-                self.packages.append(data)
-                self.archive.add_bytes(file.source, out, file.target)
-            else:
-                self.archive.add(file.source, file.target)
-            return
+                out, data = rewrite_conda_meta(source)
+                return out, None, data
+            return None, None, None
 
         elif file.file_mode not in ('text', 'binary', 'unknown'):
             raise ValueError("unknown file_mode: %r" % file.file_mode)  # pragma: no cover
 
-        elif os.path.isdir(file.source) or os.path.islink(file.source):
-            self.archive.add(file.source, file.target)
-            return
+        elif os.path.isdir(source) or os.path.islink(source):
+            return None, None, None
 
         file_mode = file.file_mode
         placeholder = file.prefix_placeholder
-        if (
-            self.has_dest
-            or file_mode == "unknown"
-            or file_mode == "text"
-            and file.target.startswith(BIN_DIR)
-        ):
+        if file_mode == 'unknown':
+            data = self._read_if_has_prefix(source, self.prefix)
+            if data is None:
+                # The prefix doesn't appear in the file, there's nothing to
+                # replace or record. Pass the filename to the archiver as is.
+                return None, None, None
+        elif self.has_dest or file_mode == "text" and file.target.startswith(BIN_DIR):
             # In each of these cases, we need to inspect the file contents here.
-            with open(file.source, 'rb') as fil:
-                data = fil.read()
+            data = self._read_if_has_prefix(source, placeholder)
+            if data is None:
+                # The placeholder doesn't appear in the file, so neither prefix
+                # replacement nor shebang rewriting would change it. Pass the
+                # filename to the archiver as is.
+                if self.has_dest:
+                    return None, None, None
+                return None, (file.target, placeholder, file_mode), None
         else:
             # No need to read the file; just pass the filename to the archiver.
-            self.archive.add(file.source, file.target)
-            self.prefixes.append((file.target, placeholder, file_mode))
-            return
+            return None, (file.target, placeholder, file_mode), None
 
         if file_mode == 'unknown':
             placeholder = self.prefix
@@ -1204,6 +1400,7 @@ class Packer:
             else:
                 file_mode = 'text'
 
+        prefix_record = None
         if file_mode != 'unknown':
             if self.has_dest:
                 data = replace_prefix(data, file_mode, placeholder, self.dest)
@@ -1213,9 +1410,39 @@ class Packer:
                 else:
                     fixed = False
                 if not fixed:
-                    self.prefixes.append((file.target, placeholder, file_mode))
+                    prefix_record = (file.target, placeholder, file_mode)
 
-        self.archive.add_bytes(file.source, data, file.target)
+        return data, prefix_record, None
+
+    def commit(self, file, prepared):
+        """Write a file prepared by :meth:`prepare` to the archive."""
+        # Windows note:
+        # When adding files to an archive, that archive is generally
+        # case-sensitive.  The target paths can be mixed case, and that means
+        # that they will be distinct directories in the archive.
+        #
+        # If those files are then extracted onto a case-sensitive file-system
+        # (such as a network share), Windows will not be able to traverse them
+        # correctly.
+        #
+        # The simple (undesirable) solution is to normalize (lowercase) the
+        # filenames when adding them to the archive.
+        #
+        # A nicer solution would be to note the "canonical" capitalization of a
+        # prefix when it first occurs, and use that every time the prefix
+        # occurs subsequently.
+        #
+        # We just ignore this problem for the time being.
+        data, prefix_record, package = prepared
+        source = file.source
+        if package is not None:
+            self.packages.append(package)
+        if prefix_record is not None:
+            self.prefixes.append(prefix_record)
+        if data is None:
+            self.archive.add(source, file.target)
+        else:
+            self.archive.add_bytes(source, data, file.target)
 
     def _write_text_file(self, fpath, ftext, executable=False):
         fil = tempfile.NamedTemporaryFile(mode="w", delete=False)
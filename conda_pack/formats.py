@@ -1,5 +1,4 @@
 import errno
-import gzip
 import os
 import shutil
 import stat
@@ -10,7 +9,6 @@ import tempfile
 import threading
 import time
 import zipfile
-import zlib
 from contextlib import closing
 from functools import partial
 from io import BytesIO
@@ -19,6 +17,15 @@ from multiprocessing.pool import ThreadPool
 from .compat import Queue, on_win
 from .core import CondaPackException
 
+try:
+    # zlib-ng is a faster drop-in replacement for zlib, use it for gzip
+    # compression if it's installed
+    from zlib_ng import gzip_ng as gzip
+    from zlib_ng import zlib_ng as zlib
+except ImportError:
+    import gzip
+    import zlib
+
 
 def _parse_n_threads(n_threads=1):
     if n_threads == -1:
@@ -299,6 +306,11 @@ class ArchiveBase:
         self._add_bytes(source, sourcebytes, target)
 
 
+# File contents are copied into tar archives in chunks of this size, rather
+# than tarfile's default of 16 KiB, to cut down on read and write calls.
+_COPY_BUFSIZE = 2**20
+
+
 class TarArchive(ArchiveBase):
     def __init__(
         self, fileobj, arcroot, close_file=False, mode="w", compresslevel=4, mtime=None
@@ -317,6 +329,7 @@ class TarArchive(ArchiveBase):
         self.archive = tarfile.open(fileobj=self.fileobj,
                                     dereference=on_win,
                                     mode=self.mode,
+                                    copybufsize=_COPY_BUFSIZE,
                                     **kwargs)
         return self
 
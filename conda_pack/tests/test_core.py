@@ -10,7 +10,18 @@ import pytest
 
 from conda_pack import CondaEnv, CondaPackException, pack
 from conda_pack.compat import load_source, on_win
-from conda_pack.core import BIN_DIR, File, name_to_prefix
+from conda_pack.core import (
+    BIN_DIR,
+    PREFIX_PLACEHOLDER,
+    File,
+    Packer,
+    _map_threaded,
+    load_files,
+    name_to_prefix,
+    read_has_prefix,
+    read_noarch_type,
+    rewrite_shebang,
+)
 
 from .conftest import (
     activate_scripts_path,
@@ -47,7 +58,7 @@ def bad_conda_exe(tmpdir_factory, monkeypatch):
     tmpdir = str(tmpdir_factory.mktemp('bin'))
     fake_conda = os.path.join(tmpdir, 'conda.bat' if on_win else 'conda')
     with open(fake_conda, 'w') as f:
-        f.write('ECHO Failed\r\nEXIT /B 1' if on_win else 'echo "Failed"\nexit 1')
+        f.write('ECHO Failed\r\nEXIT /B 1' if on_win else '#!/bin/sh\necho "Failed"\nexit 1')
     os.chmod(fake_conda, os.stat(fake_conda).st_mode | 0o111)
 
     monkeypatch.setenv('PATH', tmpdir, prepend=os.pathsep)
@@ -183,10 +194,210 @@ def test_load_environment_ignores(py37_env):
         assert fpath not in lk or not lk[fpath].source.startswith(py37_path)
 
 
+def test_load_files(tmpdir):
+    prefix = str(tmpdir)
+    for d in ["a/empty", "a/b/c", "pkgs/x"]:
+        os.makedirs(os.path.join(prefix, d))
+    for f in ["top", "junk~", "a/b/c/f", "pkgs/x/f"]:
+        with open(os.path.join(prefix, f), "w"):
+            pass
+    expected = {"top", "a/b/c/f", "a/empty"}
+
+    if not on_win:
+        os.symlink(os.path.join(prefix, "a", "b"), os.path.join(prefix, "a", "linkdir"))
+        os.symlink("missing", os.path.join(prefix, "a", "broken"))
+        expected.update(["a/linkdir", "a/broken"])
+
+    res = load_files(prefix)
+    assert {normpath(p) for p in res} == expected
+
+
+@pytest.mark.parametrize(
+    "data, expected",
+    [
+        (b"#!/prefix/bin/python -u\nprint(1)\n", b"#!/usr/bin/env python -u\nprint(1)\n"),
+        (b"#!/usr/bin/python\n/prefix\n", None),
+        (b"#!/prefix/bin/python\n/prefix\n", None),
+        (b"print('/prefix')\n", None),
+    ],
+)
+def test_rewrite_shebang(data, expected):
+    out, fixed = rewrite_shebang(data, "bin/foo", "/prefix")
+    if expected is None:
+        assert not fixed
+        assert out == data
+    else:
+        assert fixed
+        assert out == expected
+
+
+def test_read_has_prefix(tmpdir):
+    path = str(tmpdir.join("has_prefix"))
+    with open(path, "w") as f:
+        f.write("bin/foo\n"
+                "/opt/placeholder text lib/bar.txt\n"
+                "/opt/placeholder binary 'lib/with space.so'\n")
+
+    assert read_has_prefix(path) == {
+        "bin/foo": (PREFIX_PLACEHOLDER, "text"),
+        "lib/bar.txt": ("/opt/placeholder", "text"),
+        "lib/with space.so": ("/opt/placeholder", "binary"),
+    }
+
+    # Only shlex's whitespace separates fields, other whitespace is part of
+    # the path
+    with open(path, "w") as f:
+        f.write("share/a\xa0b\x0cc\n"
+                "/opt/placeholder text share/d\x0be\n")
+
+    assert read_has_prefix(path) == {
+        "share/a\xa0b\x0cc": (PREFIX_PLACEHOLDER, "text"),
+        "share/d\x0be": ("/opt/placeholder", "text"),
+    }
+
+    with open(path, "w") as f:
+        f.write("too many fields here\n")
+    with pytest.raises(ValueError):
+        read_has_prefix(path)
+
+
+def test_read_noarch_type(tmpdir):
+    pkg = str(tmpdir)
+    info = os.path.join(pkg, "info")
+    os.mkdir(info)
+    assert read_noarch_type(pkg) is None
+
+    with open(os.path.join(info, "package_metadata.json"), "w") as f:
+        json.dump({"noarch": {"type": "generic"}}, f)
+    assert read_noarch_type(pkg) == "generic"
+
+    # link.json takes precedence
+    with open(os.path.join(info, "link.json"), "w") as f:
+        json.dump({"noarch": {"type": "python"}}, f)
+    assert read_noarch_type(pkg) == "python"
+
+    with open(os.path.join(info, "link.json"), "w") as f:
+        json.dump({}, f)
+    assert read_noarch_type(pkg) is None
+
+
 def test_file():
     f = File('/root/path/to/foo/bar', 'foo/bar')
     # smoketest repr
     repr(f)
+    assert f.source == '/root/path/to/foo/bar'
+
+    f = File._relative_to('/root/path/to', 'foo/bar', is_conda=False)
+    assert f.source == os.path.join('/root/path/to', 'foo/bar')
+    assert f.target == 'foo/bar'
+    assert not f.is_conda
+
+    f.source = '/other/bar'
+    assert f.source == '/other/bar'
+
+
+class RecordingArchive:
+    def __init__(self):
+        self.added = []
+        self.added_bytes = {}
+
+    def add(self, source, target):
+        self.added.append(target)
+
+    def add_bytes(self, source, sourcebytes, target):
+        self.added_bytes[target] = sourcebytes
+
+
+@pytest.mark.parametrize("mmap_threshold", [2**20, 1])
+def test_packer_unknown_files(tmpdir, monkeypatch, mmap_threshold):
+    monkeypatch.setattr("conda_pack.core._MMAP_THRESHOLD", mmap_threshold)
+    prefix = str(tmpdir)
+    contents = {
+        "no_prefix.txt": b"nothing to see here\n",
+        "empty.txt": b"",
+        "has_prefix.txt": ("path = %s/lib\n" % prefix).encode(),
+    }
+    for name, data in contents.items():
+        with open(os.path.join(prefix, name), "wb") as f:
+            f.write(data)
+
+    arc = RecordingArchive()
+    packer = Packer(prefix, arc)
+    for name in contents:
+        packer.add(File(os.path.join(prefix, name), name, is_conda=False,
+                        file_mode="unknown"))
+
+    # Files without the prefix are passed through untouched
+    assert sorted(arc.added) == ["empty.txt", "no_prefix.txt"]
+    assert arc.added_bytes == {"has_prefix.txt": contents["has_prefix.txt"]}
+    assert packer.prefixes == [("has_prefix.txt", prefix, "text")]
+
+
+def test_packer_managed_files(tmpdir):
+    pkg = str(tmpdir)
+    placeholder = "/opt/placeholder"
+    contents = {
+        "bin/with_placeholder": ("#!%s/bin/python\n" % placeholder).encode(),
+        "bin/without_placeholder": b"#!/bin/sh\necho hello\n",
+    }
+    os.mkdir(os.path.join(pkg, "bin"))
+    for name, data in contents.items():
+        with open(os.path.join(pkg, name), "wb") as f:
+            f.write(data)
+    files = [File(os.path.join(pkg, name), name, file_mode="text",
+                  prefix_placeholder=placeholder) for name in contents]
+
+    # Without a destination prefix, only the shebang is rewritten
+    arc = RecordingArchive()
+    packer = Packer("/env", arc)
+    for f in files:
+        packer.add(f)
+    assert arc.added == ["bin/without_placeholder"]
+    assert arc.added_bytes == {"bin/with_placeholder": b"#!/usr/bin/env python\n"}
+    assert packer.prefixes == [("bin/without_placeholder", placeholder, "text")]
+
+    # With a destination prefix, the placeholder is replaced
+    arc = RecordingArchive()
+    packer = Packer("/env", arc, dest_prefix="/dest")
+    for f in files:
+        packer.add(f)
+    assert arc.added == ["bin/without_placeholder"]
+    assert arc.added_bytes == {"bin/with_placeholder": b"#!/dest/bin/python\n"}
+    assert packer.prefixes == []
+
+
+def test_map_threaded():
+    items = list(range(1000))
+    res = _map_threaded(str, items, 3, chunksize=7)
+    assert list(res) == [str(i) for i in items]
+
+
+def test_pack_threaded_matches_serial(tmpdir):
+    prefix = os.path.join(str(tmpdir), "env")
+    os.makedirs(os.path.join(prefix, "conda-meta"))
+    # The history mtime is used for the generated activation scripts
+    with open(os.path.join(prefix, "conda-meta", "history"), "w"):
+        pass
+    files = []
+    for i in range(300):
+        target = "file%03d" % i
+        with open(os.path.join(prefix, target), "wb") as f:
+            # Every third file references the prefix and is rewritten
+            if i % 3 == 0:
+                f.write(("prefix is %s\n" % prefix).encode())
+            else:
+                f.write(b"no prefix here %d\n" % i)
+        files.append(File(os.path.join(prefix, target), target, file_mode="unknown"))
+    env = CondaEnv(prefix, files)
+
+    out1 = os.path.join(str(tmpdir), "out1.tar")
+    out3 = os.path.join(str(tmpdir), "out3.tar")
+    env.pack(output=out1, n_threads=1)
+    env.pack(output=out3, n_threads=3)
+
+    assert filecmp.cmp(out1, out3, shallow=False)
+    with tarfile.open(out3) as fil:
+        assert fil.getnames()[:300] == [f.target for f in files]
 
 
 def test_loaded_file_properties(py37_env):
@@ -242,6 +453,17 @@ def test_include_exclude(py37_env):
     assert len(env3) + 1 == len(env4)
 
 
+def test_include_exclude_patterns():
+    targets = ["bin/c", "lib/a.py", "lib/a.pyc", "lib/sub/b.pyc"]
+    env = CondaEnv("prefix", [File("/src/" + t, t) for t in targets])
+
+    env2 = env.exclude("*.pyc")
+    assert [f.target for f in env2] == ["bin/c", "lib/a.py"]
+
+    env3 = env2.include("lib/sub/*")
+    assert [f.target for f in env3] == ["bin/c", "lib/a.py", "lib/sub/b.pyc"]
+
+
 def test_output_and_format(py37_env):
     output, format = py37_env._output_and_format()
     assert output == "py37.tar.gz"
@@ -460,10 +682,43 @@ def test_zip64(tmpdir):
         large_env.pack(output=out_path, zip_64=False)
     assert 'ZIP64' in str(exc.value)
     assert not os.path.exists(out_path)
+    # The temporary file next to the output is cleaned up
+    assert os.listdir(str(tmpdir)) == ['source.txt']
 
     # Works fine if ZIP64 not disabled
     large_env.pack(output=out_path)
     assert os.path.exists(out_path)
+    assert sorted(os.listdir(str(tmpdir))) == ['large.zip', 'source.txt']
+
+
+def test_pack_interrupted(tmpdir, monkeypatch):
+    source = os.path.join(str(tmpdir), 'source.txt')
+    with open(source, 'wb') as f:
+        f.write(b'0')
+    env = CondaEnv('small', files=[File(source, target='foo')])
+    out_path = os.path.join(str(tmpdir), 'small.tar')
+
+    def interrupt(self, file, prepared):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(Packer, 'commit', interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        env.pack(output=out_path)
+    # The temporary file next to the output is cleaned up
+    assert os.listdir(str(tmpdir)) == ['source.txt']
+
+
+def test_pack_no_archive(tmpdir):
+    source = os.path.join(str(tmpdir), 'source.txt')
+    with open(source, 'wb') as f:
+        f.write(b'0')
+    env = CondaEnv('small', files=[File(source, target='foo')])
+    out_path = os.path.join(str(tmpdir), 'small')
+
+    env.pack(output=out_path, format='no-archive')
+    # No temporary archive file is created or moved into the output
+    assert sorted(os.listdir(out_path)) == ['bin', 'foo']
+    assert sorted(os.listdir(str(tmpdir))) == ['small', 'source.txt']
 
 
 def test_force(tmpdir, py37_env):
@@ -276,3 +276,29 @@ def test_format_parallel(tmpdir, format, root_and_paths):
             out.extractall(out_dir)
 
     check(out_dir, links=(not on_win), root=root)
+
+
+_GZIP_FALLBACK_SCRIPT = """
+import gzip, sys, tarfile, zlib
+sys.modules['zlib_ng'] = None  # make the optional import fail
+from conda_pack.formats import archive
+import conda_pack.formats as formats
+assert formats.gzip is gzip and formats.zlib is zlib
+source, out_path, n_threads = sys.argv[1], sys.argv[2], int(sys.argv[3])
+with open(out_path, 'wb') as fil:
+    with archive(fil, out_path, '', 'tar.gz', n_threads=n_threads, mtime=0) as arc:
+        arc.add(source, 'source.txt')
+with tarfile.open(out_path) as fil:
+    assert fil.extractfile('source.txt').read() == b'hello'
+"""
+
+
+@pytest.mark.parametrize('n_threads', [1, 2])
+def test_gzip_stdlib_fallback(tmpdir, n_threads):
+    # zlib-ng is optional, gzip output must work with the stdlib alone
+    source = join(str(tmpdir), 'source.txt')
+    with open(source, 'wb') as fil:
+        fil.write(b'hello')
+    out_path = join(str(tmpdir), 'out.tar.gz')
+    check_output([sys.executable, '-c', _GZIP_FALLBACK_SCRIPT,
+                  source, out_path, str(n_threads)], stderr=STDOUT)
@@ -32,6 +32,7 @@ setup(
         conda-pack=conda_pack.cli:main
       """,
     install_requires=["setuptools"],
+    extras_require={"zlib-ng": ["zlib-ng >=0.4.0"]},
     python_requires=">=3.8",
     zip_safe=False,
 )